@@ -1,18 +1,27 @@
 import os
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from random import SystemRandom
 
 import chipwhisperer as cw
 import numpy as np
 
-from encrypt import aes_encrypt
+from encrypt import Aes128Ecb
+from util import savez_zst
 
 
 _cryptgen = SystemRandom()
 
 
+@lru_cache(maxsize=4)
+def _reference_cipher(key:bytes) -> Aes128Ecb:
+    # Fixed-key campaigns reuse one cipher instead of rebuilding it per trace
+    return Aes128Ecb(key)
+
+
 def _setup_cwlite_cw305_100t() -> tuple[cw.scopes.OpenADC, cw.targets.CW305]:
     scope = cw.scopes.OpenADC()
     scope.con(idProduct=0xace2, prog_speed=int(10E6))
@@ -83,18 +92,18 @@ class DutIO:
 
     BYTECNT_SIZE = 7
 
-    data:bytearray
-    key:int
-    computed_data:bytearray
+    data:bytes
+    key:bytes
+    computed_data:bytes
 
     @staticmethod
-    def format_write(bytes:list[int]) -> bytearray:
-        assert all(0 <= val <= 255 for val in bytes)
-        return bytearray(bytes[::-1])
+    def format_write(data:bytes) -> bytearray:
+        # bytearray() already rejects values outside [0, 255]
+        return bytearray(data[::-1])
 
     @staticmethod
-    def format_read(data:bytearray) -> list[int]:
-        return list(data[::-1])
+    def format_read(data:bytearray) -> bytes:
+        return bytes(data[::-1])
 
 
 class DutIOPattern(ABC):
@@ -112,14 +121,23 @@ class DutIOPattern(ABC):
 
 class DutIOTestPattern(DutIOPattern):
 
-    def __init__(self, N_traces, average_over, key):
+    def __init__(self, N_traces, average_over, key:int):
         super().__init__(N_traces, average_over)
-        self.key = key
+        self.key = key.to_bytes(DutIO.DUT_KEYIN_LEN_IN_BYTES, 'big')
+        # Draw the plaintexts of all N_traces in one call up front
+        self._data = _cryptgen.randbytes(N_traces * DutIO.DUT_DATAIN_LEN_IN_BYTES)
+        self._i_next = 0
 
     def next(self) -> DutIO:
+        n = DutIO.DUT_DATAIN_LEN_IN_BYTES
+        if self._i_next < self.N_traces:
+            data = self._data[self._i_next*n:(self._i_next+1)*n]
+        else:
+            data = _cryptgen.randbytes(n)
+        self._i_next += 1
         return DutIO(
-            data=bytearray(_cryptgen.randrange(0, stop=2*128)for _ in range(16)),
-            key= self.key,
+            data=data,
+            key=self.key,
             computed_data=None)
 
 
@@ -132,6 +150,9 @@ class TraceExt:
 
 def capture_trace(scope:cw.scopes.OpenADC, target:cw.targets.CW305, ktp:DutIOPattern):
     DISABLE_USB_CLK = False
+    # scope.capture() only returns once the trigger window has been sampled,
+    # which covers the whole AES run, so polling GO is only a debug check.
+    DEBUG_VERIFY_TARGET_DONE = False
 
     def trigger_target():
         scope.arm()
@@ -144,75 +165,138 @@ def capture_trace(scope:cw.scopes.OpenADC, target:cw.targets.CW305, ktp:DutIOPat
             target.usb_clk_setenabled(True)
 
     def verify_target_done():
-        i_retry = 0
+        # Poll with exponential backoff: the DUT is usually done on the first
+        # read, so a fixed sleep would dominate the time per trace.
+        delay = 0.0
+        deadline = time.monotonic() + 5.0
         while target.fpga_read(DutIO.REG_DUT_GO, 1)[0] == 0x01:
-            i_retry += 1
-            time.sleep(0.05)
-            if i_retry > 100:
+            if time.monotonic() > deadline:
                 return False
+            if delay:
+                time.sleep(delay)
+            delay = min(delay*2 if delay else 5E-5, 2E-3)
         return True
 
     target.bytecount_size = DutIO.BYTECNT_SIZE
     assert ktp.average_over >= 1
-    waves = []
+    # float64 accumulator: summing many float32 repetitions would lose precision.
+    # Sized from the first wave, so no scope register read is needed per trace.
+    acc = None
     dut_io = ktp.next()
+    # Inputs are identical for every repetition, so format them and compute
+    # the expected output once
+    data_in_reg = DutIO.format_write(dut_io.data)
+    key_in_reg = DutIO.format_write(dut_io.key)
+    expected_out = _reference_cipher(dut_io.key).encrypt_block(dut_io.data)
 
     for i_rep in range(ktp.average_over):
         # Write Inputs
-        data_in_bytes = list(dut_io.data)
-        key_in_bytes = list(dut_io.key.to_bytes(DutIO.DUT_KEYIN_LEN_IN_BYTES))
-        target.fpga_write(DutIO.REG_DUT_DATAIN, DutIO.format_write(data_in_bytes))
-        target.fpga_write(DutIO.REG_DUT_KEYIN, DutIO.format_write(key_in_bytes))
+        target.fpga_write(DutIO.REG_DUT_DATAIN, data_in_reg)
+        target.fpga_write(DutIO.REG_DUT_KEYIN, key_in_reg)
         # Start computation
         trigger_target()
         if scope.capture():
             raise Exception("Scope timed out.")
-        if not verify_target_done():
+        if DEBUG_VERIFY_TARGET_DONE and not verify_target_done():
             raise Exception("Target did not report done in time.")
         # Retrieve results
-        dut_computed_data = DutIO.format_read(target.fpga_read(DutIO.REG_DUT_DATAOUT, DutIO.DUT_DATAOUT_LEN_IN_BYTES))
-        dut_io.computed_data = dut_computed_data
-        FPGA_data = int.from_bytes(dut_computed_data)
+        dut_io.computed_data = DutIO.format_read(target.fpga_read(DutIO.REG_DUT_DATAOUT, DutIO.DUT_DATAOUT_LEN_IN_BYTES))
         # Verify output
-        expected_out = aes_encrypt(bytearray(data_in_bytes), bytearray(key_in_bytes))['ciphertext']
-        # convert from bytes to match with computed data
-        expected_data = int.from_bytes(expected_out)
-        if FPGA_data != expected_data:
-            print(f"Output mismatch.\nExpected: {str(expected_data)}\nActual: {str(dut_io.computed_data)}")
+        if dut_io.computed_data != expected_out:
+            print(f"Output mismatch.\nExpected: {expected_out.hex()}\nActual: {dut_io.computed_data.hex()}")
         # Retrieve wave
         wave = scope.get_last_trace()
         if len(wave) == 0:
             raise Exception("Scope returned empty trace.")
-        waves.append(wave)
-    mean_wave = waves[0] if ktp.average_over==1 else np.mean(waves, axis=0)
+        # Accumulate in place instead of stacking all repetitions for np.mean
+        if acc is None:
+            acc = np.array(wave, dtype=np.float64)
+        else:
+            np.add(acc, wave, out=acc)
+    # Divide in place so the only new array is the float32 result
+    acc /= ktp.average_over
+    mean_wave = acc.astype(np.float32)
     return TraceExt(mean_wave, dut_io, scope.adc.trig_count)
 
 
+def _save_trace_batch(path:str, scratch_path:str, n_traces:int, data:np.ndarray, computed_data:np.ndarray):
+    # The scratch file is only deleted once the archive is written; if the
+    # save fails it is kept, as it is the only copy of the batch's waves.
+    waves = np.load(scratch_path, mmap_mode="r")
+    savez_zst(
+        path,
+        wave=waves[:n_traces],
+        dut_io_data=data[:n_traces],
+        dut_io_computed_data=computed_data[:n_traces])
+    del waves  # unmap before deleting the scratch file
+    os.remove(scratch_path)
+
+
 def _create_trace_writer():
     STORE_PATH = "src/py/data"
     TRACES_PER_FILE = 100000
     #
     file_counter = 3
-    trace_batch:list[TraceExt] = []
+    # Waves are streamed into an on-disk scratch array sized on the first trace
+    # of each batch, DUT inputs/outputs into a ring of two preallocated buffer
+    # pairs: one being filled, one owned by the save in flight.
+    waves_mm:np.memmap = None
+    data_bufs = [np.empty((TRACES_PER_FILE, DutIO.DUT_DATAIN_LEN_IN_BYTES), dtype=np.uint8) for _ in range(2)]
+    computed_data_bufs = [np.empty((TRACES_PER_FILE, DutIO.DUT_DATAOUT_LEN_IN_BYTES), dtype=np.uint8) for _ in range(2)]
+    i_in_batch = 0
+    # Compression runs on a worker thread (zstd releases the GIL) so capture
+    # continues while the previous batch is written. At most one batch is in
+    # flight; the capture loop only blocks if it fills the next one first.
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending_save:Future = None
     os.makedirs(STORE_PATH, exist_ok=True)
     #
     def write_traces_to_disk(trace:TraceExt, flush:bool):
-        nonlocal file_counter
-        trace_batch.append(trace)
-        if flush or (len(trace_batch) >= TRACES_PER_FILE):
-            np.savez_compressed(
-                f"{STORE_PATH}/traces_{file_counter}.npz",
-                wave=[trace.wave for trace in trace_batch],
-                dut_io_data=[trace.dut_io.data for trace in trace_batch],
-                dut_io_computed_data=[trace.dut_io.computed_data for trace in trace_batch])
-            trace_batch.clear()
+        nonlocal file_counter, waves_mm, i_in_batch, pending_save
+        scratch_path = f"{STORE_PATH}/traces_{file_counter}.wave.npy"
+        # The save of the previous batch (other slot) is waited for before
+        # this slot is submitted, so it is never reused while still in flight.
+        data_buf = data_bufs[file_counter % 2]
+        computed_data_buf = computed_data_bufs[file_counter % 2]
+        if waves_mm is None:
+            waves_mm = np.lib.format.open_memmap(
+                scratch_path, mode="w+", dtype=np.float32,
+                shape=(TRACES_PER_FILE, len(trace.wave)))
+        waves_mm[i_in_batch] = trace.wave
+        data_buf[i_in_batch] = np.frombuffer(trace.dut_io.data, dtype=np.uint8)
+        computed_data_buf[i_in_batch] = np.frombuffer(trace.dut_io.computed_data, dtype=np.uint8)
+        i_in_batch += 1
+        if flush or (i_in_batch >= TRACES_PER_FILE):
+            waves_mm.flush()
+            waves_mm = None
+            if pending_save is not None:
+                pending_save.result()
+            pending_save = executor.submit(
+                _save_trace_batch, f"{STORE_PATH}/traces_{file_counter}.npz.zst",
+                scratch_path, i_in_batch, data_buf, computed_data_buf)
+            i_in_batch = 0
             file_counter += 1
-    return write_traces_to_disk
+        if flush:
+            pending_save.result()
+            pending_save = None
+    #
+    def close_trace_writer():
+        # Wait for a save still in flight and stop the worker. A batch that
+        # was never submitted (capture aborted) is removed here; a submitted
+        # batch whose save failed keeps its scratch file.
+        nonlocal waves_mm
+        try:
+            executor.shutdown(wait=True)
+        finally:
+            if waves_mm is not None:
+                waves_mm = None
+                os.remove(f"{STORE_PATH}/traces_{file_counter}.wave.npy")
+    return write_traces_to_disk, close_trace_writer
 
 
 if __name__ == "__main__":
     REPORT_INTERVAL = 500
-    trace_writer = _create_trace_writer()
+    trace_writer, close_trace_writer = _create_trace_writer()
     # We capture 5000 traces for analysis
     ktp:DutIOPattern = DutIOTestPattern(1000, 1, key=0x10a5_8869_d74b_e5a3_74cf_867c_fb47_3859)
     try:
@@ -230,6 +314,7 @@ if __name__ == "__main__":
             scope.dis()
         if 'target' in locals():
             target.dis()
+        close_trace_writer()
 
 
 
@@ -1,3 +1,4 @@
+import numpy as np
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
@@ -37,3 +38,53 @@ def aes_decrypt(ciphertext: bytes, key: bytes) -> bytes:
     assert len(ciphertext) == 16, "AES ECB ciphertext must be 16 bytes"
     cipher = AES.new(key, AES.MODE_ECB)
     return cipher.decrypt(ciphertext)
+
+class Aes128Ecb:
+    """
+    AES-128 ECB encryptor bound to a fixed key.
+
+    The cipher object (and with it the key schedule) is created once and
+    reused for every call, which matters when encrypting many blocks under
+    the same key, e.g. reference ciphertexts for a fixed-key capture.
+    """
+
+    def __init__(self, key: bytes):
+        assert len(key) == 16, "AES-128 requires a 16-byte key"
+        self.key = bytes(key)
+        self._cipher = AES.new(self.key, AES.MODE_ECB)
+
+    def encrypt_block(self, data: bytes) -> bytes:
+        """Encrypts a single 16-byte block."""
+        assert len(data) == 16, "AES ECB requires a 16-byte block"
+        return self._cipher.encrypt(data)
+
+    def encrypt_blocks(self, plaintexts: np.ndarray) -> np.ndarray:
+        """
+        Encrypts many blocks in a single call.
+
+        All blocks are passed to the cipher as one buffer, which uses
+        AES-NI where available.
+
+        Args:
+            plaintexts (np.ndarray): uint8 array of shape (N, 16), one block per row.
+
+        Returns:
+            np.ndarray: uint8 array of shape (N, 16) with the ciphertexts.
+        """
+        plaintexts = np.ascontiguousarray(plaintexts, dtype=np.uint8)
+        assert plaintexts.ndim == 2 and plaintexts.shape[1] == 16, "plaintexts must have shape (N, 16)"
+        ciphertext = self._cipher.encrypt(plaintexts.tobytes())
+        return np.frombuffer(ciphertext, dtype=np.uint8).reshape(-1, 16)
+
+def aes_encrypt_many(plaintexts: np.ndarray, key: bytes) -> np.ndarray:
+    """
+    Encrypts many blocks with AES-128 in ECB mode in a single call.
+
+    Args:
+        plaintexts (np.ndarray): uint8 array of shape (N, 16), one block per row.
+        key (bytes): 16-byte AES key.
+
+    Returns:
+        np.ndarray: uint8 array of shape (N, 16) with the ciphertexts.
+    """
+    return Aes128Ecb(key).encrypt_blocks(plaintexts)
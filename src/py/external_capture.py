@@ -25,16 +25,18 @@ Notes
 
 """
 
+import json
 import os
 import time
-from dataclasses import dataclass
-from random import SystemRandom
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 
 import numpy as np
 import pyvisa
 import chipwhisperer as cw
 
+from util import savez_zst
+
 # User Configuration
 
 # Total number of traces to capture
@@ -59,12 +61,21 @@ TIME_PER_DIV = 2e-6
 TRIG_LEVEL_V = 1.5
 POINTS_PER_TRACE = 10000
 
+# Store the scope's raw 8-bit samples instead of float32 volts. Quarters the
+# file size; the scaling needed to convert back is kept in rigol_config as
+# volts = (raw - y_ref) * y_inc + y_org.
+STORE_RAW_SAMPLES = False
+
 # Force a specific VISA resource (e.g. 'USB0::0x1AB1::0x0588::DS1ZA170600000::INSTR')
 RIGOL_VISA_FORCE = None
 
+# Last auto-detected VISA resource, tried first on the next run so the full
+# resource scan is only needed when the scope has moved
+RIGOL_VISA_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "advseceng25", "rigol_visa.txt")
+
 # FPGA bitstream and output save path
 BITSTREAM = r"C:\Users\Admin\Desktop\Security\advseceng25-sca-framework\out\cw305.bit"
-SAVE_PATH = r"C:\Users\Admin\Desktop\Security\advseceng25-sca-framework\src\py\data\traces_mso5074.npz"
+SAVE_PATH = r"C:\Users\Admin\Desktop\Security\advseceng25-sca-framework\src\py\data\traces_mso5074.npz.zst"
 FIXED_KEY_HEX = "10A58869D74BE5A374CF867CFB473859"
 
 # ----------------------------
@@ -103,6 +114,17 @@ class RigolScope:
         self.visa_resource = visa_resource
         self.rm = None
         self.inst = None
+        # Waveform byte -> voltage scaling, cached by setup_for_single_trace
+        self.y_inc = None
+        self.y_org = None
+        self.y_ref = None
+        # The same mapping folded into volts = raw * _scale + _bias
+        self._scale = None
+        self._bias = None
+        # Smoothed time from the first trigger-status poll to an accepted
+        # armed state, learned by clear_and_arm; None until the first
+        # successful arm.
+        self._arm_latency_ewma = None
 
     def connect(self):
         """Connect to the oscilloscope via pyvisa.
@@ -110,10 +132,13 @@ class RigolScope:
         If no visa_resource is provided, auto-discovery looks for a device
         whose *IDN? contains 'RIGOL' and 'MSO5'.
         """
+        # Creating a ResourceManager probes the VISA backends, so do it once
+        # and share it with device discovery.
+        if self.rm is None:
+            self.rm = pyvisa.ResourceManager()
         if not self.visa_resource:
             self.visa_resource = self._find_device()
         print(f"[INFO] Connecting to Rigol at: {self.visa_resource}")
-        self.rm = pyvisa.ResourceManager()
         self.inst = self.rm.open_resource(self.visa_resource)
         # Increase timeout to tolerate long operations (binary transfers, etc.)
         self.inst.timeout = 30000
@@ -125,19 +150,53 @@ class RigolScope:
         print(f"[INFO] Connected: {self.inst.query('*IDN?').strip()}")
 
     def _find_device(self, hint: str = "MSO5") -> str:
-        """Scan VISA resources and return the first Rigol MSO5 device found."""
-        rm = pyvisa.ResourceManager()
-        for res in rm.list_resources():
-            try:
-                inst = rm.open_resource(res, open_timeout=2000)
-                idn = inst.query("*IDN?").strip()
-                inst.close()
-                if "RIGOL" in idn and hint in idn:
-                    return res
-            except Exception:
-                pass
+        """Return the VISA resource of the first Rigol MSO5 device found.
+
+        The resource cached by the previous run is probed first. Otherwise
+        USB instruments with Rigol's vendor ID (0x1AB1) are probed so
+        unrelated devices are not opened; all resources are scanned only if
+        none of those match (e.g. a scope attached over LAN). The result is
+        written back to RIGOL_VISA_CACHE.
+        """
+        try:
+            with open(RIGOL_VISA_CACHE) as f:
+                cached = f.read().strip()
+        except OSError:
+            cached = None
+        if cached and self._probe(cached, hint, open_timeout=1000):
+            return cached
+
+        rm = self.rm
+        candidates = list(rm.list_resources("USB?*::0x1AB1::?*::INSTR"))
+        others = [res for res in rm.list_resources() if res not in candidates]
+        for res in candidates + others:
+            if res != cached and self._probe(res, hint):
+                try:
+                    os.makedirs(os.path.dirname(RIGOL_VISA_CACHE), exist_ok=True)
+                    with open(RIGOL_VISA_CACHE, "w") as f:
+                        f.write(res)
+                except OSError as e:
+                    print(f"[WARN] Could not cache VISA resource: {e}")
+                return res
         raise RuntimeError("Rigol scope not found. Provide RIGOL_VISA_FORCE to override.")
 
+    def _probe(self, res: str, hint: str, open_timeout: int = 2000) -> bool:
+        """Return True if `res` answers *IDN? as a Rigol device matching `hint`."""
+        try:
+            inst = self.rm.open_resource(res, open_timeout=open_timeout)
+        except Exception:
+            return False
+        try:
+            inst.timeout = open_timeout
+            idn = inst.query("*IDN?").strip()
+        except Exception:
+            return False
+        finally:
+            # Close the probe session on every path, including a failed
+            # *IDN?, so it does not hold the device open
+            inst.close()
+        return "RIGOL" in idn and hint in idn
+
     def setup_for_single_trace(self):
         """Configure scope for one-trace capture.
 
@@ -145,52 +204,67 @@ class RigolScope:
         channel scaling and trigger. It places the scope in STOP so callers
         can explicitly arm it prior to each trace.
         """
-        # Reset instrument state and stop any running acquisitions
+        # Reset instrument state and wait for the reset to complete before
+        # sending the configuration
         self.inst.write("*RST")
-        self.inst.write(":STOP")
+        self.inst.query("*OPC?")
+
+        # The configuration is sent as a single compound command (every
+        # header is rooted with ':'), so setup is one transaction rather
+        # than one per setting.
+        cmds = [":STOP"]
 
         # Acquisition mode selection
         if ACQUISITION_MODE == 'AVERAGE':
-            self.inst.write(":ACQ:TYPE AVER")
-            self.inst.write(f":ACQ:COUN {HARDWARE_AVERAGES}")
+            cmds += [":ACQ:TYPE AVER", f":ACQ:COUN {HARDWARE_AVERAGES}"]
         elif ACQUISITION_MODE == 'HRES':
-            self.inst.write(":ACQ:TYPE NORM")
-            self.inst.write(":ACQ:MODE HRES")
+            cmds += [":ACQ:TYPE NORM", ":ACQ:MODE HRES"]
         else:
-            self.inst.write(":ACQ:TYPE NORM")
-            self.inst.write(":ACQ:MODE NORM")
+            cmds += [":ACQ:TYPE NORM", ":ACQ:MODE NORM"]
 
         # Memory depth and points per trace
-        self.inst.write(f":ACQ:MDEP {POINTS_PER_TRACE}")
+        cmds.append(f":ACQ:MDEP {POINTS_PER_TRACE}")
 
         # Channel setup (display, coupling, probe factor, vertical scale)
-        self.inst.write(f":{MEAS_CH}:DISP ON")
-        self.inst.write(f":{MEAS_CH}:COUP DC")
-        self.inst.write(f":{MEAS_CH}:PROB 1")
-        self.inst.write(f":{MEAS_CH}:SCAL {VERTICAL_SCALE_V}")
+        cmds += [
+            f":{MEAS_CH}:DISP ON",
+            f":{MEAS_CH}:COUP DC",
+            f":{MEAS_CH}:PROB 1",
+            f":{MEAS_CH}:SCAL {VERTICAL_SCALE_V}",
+        ]
 
         # Bandwidth limit (optional)
         if BANDWIDTH_LIMIT_MHZ:
-            self.inst.write(f":{MEAS_CH}:BWL {BANDWIDTH_LIMIT_MHZ}M")
+            cmds.append(f":{MEAS_CH}:BWL {BANDWIDTH_LIMIT_MHZ}M")
         else:
-            self.inst.write(f":{MEAS_CH}:BWL OFF")
+            cmds.append(f":{MEAS_CH}:BWL OFF")
 
         # Timebase
-        self.inst.write(":TIM:MODE MAIN")
-        self.inst.write(f":TIM:SCAL {TIME_PER_DIV}")
+        cmds += [":TIM:MODE MAIN", f":TIM:SCAL {TIME_PER_DIV}"]
 
         # Trigger setup
         trig_src = TRIG_SRC if TRIGGER_MODE == "digital" else MEAS_CH
         trig_lvl = TRIG_LEVEL_V if TRIGGER_MODE == "digital" else 0.01
-        self.inst.write(":TRIG:MODE EDGE")
-        self.inst.write(f":TRIG:EDGE:SOUR {trig_src}")
-        self.inst.write(":TRIG:EDGE:SLOP POS")
-        self.inst.write(f":TRIG:LEV {trig_lvl}")
+        cmds += [
+            ":TRIG:MODE EDGE",
+            f":TRIG:EDGE:SOUR {trig_src}",
+            ":TRIG:EDGE:SLOP POS",
+            f":TRIG:LEV {trig_lvl}",
+        ]
 
         # Waveform transfer configuration
-        self.inst.write(":WAV:SOUR " + MEAS_CH)
-        self.inst.write(":WAV:MODE NORM")
-        self.inst.write(":WAV:FORM BYTE")
+        cmds += [":WAV:SOUR " + MEAS_CH, ":WAV:MODE NORM", ":WAV:FORM BYTE"]
+
+        self.inst.write(";".join(cmds))
+
+        # The scaling only depends on the vertical settings above, which stay
+        # fixed for the session, so query it once instead of per trace. The
+        # preamble returns all of it in one round-trip:
+        # format,type,points,count,xinc,xorigin,xref,yinc,yorigin,yref
+        preamble = self.inst.query(':WAV:PRE?').strip().split(',')
+        self.y_inc, self.y_org, self.y_ref = (float(v) for v in preamble[7:10])
+        self._scale = np.float32(self.y_inc)
+        self._bias = np.float32(self.y_org - self.y_ref * self.y_inc)
 
     # Trigger / arming helpers
     def query_trigger_status(self) -> str:
@@ -224,6 +298,12 @@ class RigolScope:
         4. Wait fixed delay (delay_after_sing) to give hardware a moment.
         5. Poll ':TRIG:STAT?' until an accepted armed token appears or timeout.
         6. Retry the entire sequence up to SCOPE_ARM_RETRIES times.
+
+        Once an arm has succeeded, steps 3 and 4 are replaced by a sleep of
+        half the observed arming latency (an EWMA over previous calls), so
+        steady-state arming is not paced by the fixed delay. The latency is
+        measured from the first poll to the poll that sees the armed state,
+        so neither that sleep nor the settle path is counted in it.
         """
         if timeout is None:
             timeout = SCOPE_ARM_TIMEOUT
@@ -239,28 +319,43 @@ class RigolScope:
                 # Request a single acquisition
                 self.inst.write(":SING")
 
-                # Block until the instrument has processed queued commands.
-                # Some firmwares honor '*OPC?' and it returns '1' when all
-                # operations are complete. If it fails, we fall back to a
-                # small sleep below.
-                try:
-                    self.inst.query("*OPC?")
-                except Exception:
-                    # *OPC? may not be supported by all firmwares or may
-                    # time out; nonetheless continue after a short delay.
-                    pass
-
-                # Allow a short fixed delay for hardware to settle
-                if delay_after_sing > 0:
-                    time.sleep(delay_after_sing)
-
-                # Poll for an 'armed' state until timeout
-                start = time.time()
-                while (time.time() - start) < timeout:
+                if self._arm_latency_ewma is not None:
+                    time.sleep(0.5 * self._arm_latency_ewma)
+                else:
+                    # Block until the instrument has processed queued commands.
+                    # Some firmwares honor '*OPC?' and it returns '1' when all
+                    # operations are complete. If it fails, we fall back to a
+                    # small sleep below.
+                    try:
+                        self.inst.query("*OPC?")
+                    except Exception:
+                        # *OPC? may not be supported by all firmwares or may
+                        # time out; nonetheless continue after a short delay.
+                        pass
+
+                    # Allow a short fixed delay for hardware to settle
+                    if delay_after_sing > 0:
+                        time.sleep(delay_after_sing)
+
+                # Poll for an 'armed' state until timeout, backing off from
+                # 1 ms to 20 ms between polls
+                poll_delay = 1e-3
+                t_first_poll = time.monotonic()
+                deadline = t_first_poll + timeout
+                while time.monotonic() < deadline:
+                    t_poll = time.monotonic()
                     st = self.query_trigger_status()
                     if any(tok in st for tok in _ACCEPTED_ARMED_STATES):
+                        latency = t_poll - t_first_poll
+                        if self._arm_latency_ewma is None:
+                            # Seed from the settle path; never start above
+                            # the fixed delay it replaces
+                            self._arm_latency_ewma = min(latency, delay_after_sing)
+                        else:
+                            self._arm_latency_ewma += 0.2 * (latency - self._arm_latency_ewma)
                         return True
-                    time.sleep(0.02)
+                    time.sleep(poll_delay)
+                    poll_delay = min(poll_delay * 2, 0.02)
 
             except Exception as e:
                 # Log exception and retry after a short backoff
@@ -272,29 +367,44 @@ class RigolScope:
 
     # Acquisition helpers
 
-    def wait_for_trace(self):
-        """Block until the oscilloscope reports the previously requested
-        operations are complete. Uses '*OPC?' which typically returns '1'
-        once the device has finished processing queued commands.
+    def wait_for_trace(self, timeout: float = 10.0):
+        """Block until the single acquisition has completed.
+
+        Polls ':TRIG:STAT?' every 10 ms until the scope reports STOP, which
+        it only does once the triggered acquisition has been stored; '*OPC?'
+        can return while the acquisition is still pending on some firmwares.
+        Raises RuntimeError if the scope does not stop within `timeout`.
         """
-        try:
-            self.inst.query("*OPC?")
-        except Exception:
-            # If query fails, continue; the caller may still attempt to read
-            # the waveform, which will raise if no data is present.
-            pass
+        deadline = time.monotonic() + timeout
+        while "STOP" not in self.query_trigger_status():
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Scope did not finish the acquisition within {timeout} s.")
+            time.sleep(0.01)
+
+    def read_raw_trace(self) -> np.ndarray:
+        """Read the last acquired waveform as the scope's raw uint8 samples.
+
+        :WAV:FORM BYTE is kept on purpose: on the MSO5000 series WORD only
+        pads each 8-bit sample to 16 bits, doubling the transfer for no
+        extra resolution.
+        """
+        return self.inst.query_binary_values(':WAV:DATA?', datatype='B', container=np.array)
 
-    def read_single_trace(self) -> np.ndarray:
+    def read_single_trace(self, out: np.ndarray | None = None) -> np.ndarray:
         """Read the last acquired waveform as a numpy array of voltages.
 
         The Rigol waveform binary transfer uses YINC/YOR/YREF to map bytes
-        to voltages. We convert accordingly and return a float32 array.
+        to voltages. We convert accordingly, using the values cached by
+        setup_for_single_trace, and return a float32 array. If `out` is
+        given (a float32 array of the trace length, e.g. a row of the
+        capture buffer) the voltages are written into it and it is returned.
         """
-        y_inc = float(self.inst.query(':WAV:YINC?'))
-        y_org = float(self.inst.query(':WAV:YOR?'))
-        y_ref = float(self.inst.query(':WAV:YREF?'))
-        raw = self.inst.query_binary_values(':WAV:DATA?', datatype='B', container=np.array)
-        return (raw.astype(np.float32) - y_ref) * y_inc + y_org
+        raw = self.read_raw_trace()
+        # (raw - y_ref) * y_inc + y_org folded into one scale and one offset,
+        # applied in place so no float temporaries are allocated.
+        trace = np.multiply(raw, self._scale, out=out, dtype=np.float32)
+        trace += self._bias
+        return trace
 
     def disconnect(self):
         """Return the scope to RUN (if possible) and close VISA resources."""
@@ -311,22 +421,26 @@ class RigolScope:
                 pass
 
 # CW305 Helpers
-@dataclass
-class TraceMeta:
-    """Simple container for trace metadata."""
-    pt: bytes
-    key: bytes
-    ct: bytes
+# FPGA register addresses of the AES design
+REG_KEY, REG_PT, REG_CT, REG_GO = 0x08, 0x09, 0x0A, 0x05
 
-_rng = SystemRandom()
+def make_plaintexts(n: int) -> np.ndarray:
+    """Generate `n` random 16-byte plaintexts using a secure RNG.
 
+    All bytes are drawn from os.urandom in a single call. Returns a uint8
+    array of shape (n, 16), one plaintext per row.
+    """
+    return np.frombuffer(os.urandom(16 * n), dtype=np.uint8).reshape(n, 16)
 
-def make_plaintexts(n: int) -> list[bytes]:
-    """Generate `n` random 16-byte plaintexts using a secure RNG.
 
-    Returns a list of bytes objects, each 16 bytes long.
+def _byteswap16_bulk(blocks: np.ndarray) -> bytes:
+    """Reverse the byte order of every 16-byte row of a (N, 16) uint8 array.
+
+    The CW305 FPGA interface expects reversed byte order. Reversing all rows
+    in one strided NumPy copy avoids a Python-level slice per trace; row `i`
+    of the result is `result[16*i:16*(i+1)]`.
     """
-    return [bytes(_rng.getrandbits(8) for _ in range(16)) for _ in range(n)]
+    return np.ascontiguousarray(blocks[:, ::-1]).tobytes()
 
 
 def setup_cw305():
@@ -355,29 +469,74 @@ def setup_cw305():
     return t
 
 
-def run_aes(target, pt, key) -> bytes:
-    """Perform a single AES encryption on the target and return the
-    resulting ciphertext bytes.
+def load_aes_key(target, key_rev):
+    """Write the AES key to the target.
+
+    The key register keeps its value between encryptions, so with a fixed key
+    this only needs to be done once per session.
+    `key_rev` must already be in FPGA (reversed) byte order.
+    """
+    target.fpga_write(REG_KEY, key_rev)
+
+
+def load_aes_inputs(target, pt_rev):
+    """Write the plaintext for the next AES encryption to the target.
 
     The CW305 FPGA interface uses reversed byte order for writes/reads;
-    therefore we reverse the plaintext/key when writing and reverse the
-    ciphertext when reading back.
+    `pt_rev` must already be reversed (see _byteswap16_bulk).
     """
-    REG_KEY, REG_PT, REG_CT, REG_GO = 0x08, 0x09, 0x0A, 0x05
-    # Helper functions to reverse byte order for the FPGA interface
-    wr = lambda x: bytearray(x[::-1])
-    rd = lambda x: bytes(x[::-1])
-
-    # Write plaintext and key, then pulse GO
-    target.fpga_write(REG_PT, wr(pt))
-    target.fpga_write(REG_KEY, wr(key))
+    target.fpga_write(REG_PT, pt_rev)
+
+
+def start_aes(target):
+    """Pulse GO to start the encryption loaded by load_aes_inputs, without
+    waiting for it to finish."""
     target.fpga_write(REG_GO, b"\x01")
 
-    # Wait for the hardware to clear GO (device sets GO=1 while busy)
+
+def read_aes_result(target) -> bytes:
+    """Return the ciphertext of the encryption started by start_aes.
+
+    Called right after start_aes, while the reader thread is still waiting
+    for the scope, so the AES core may still be busy (device sets GO=1
+    while busy). GO is polled with exponential backoff until it clears;
+    raises RuntimeError if it does not clear within 5 s.
+    """
+    delay = 0.0
+    deadline = time.monotonic() + 5.0
     while target.fpga_read(REG_GO, 1)[0] == 0x01:
-        time.sleep(0.0005)
+        if time.monotonic() > deadline:
+            raise RuntimeError("CW305 did not clear GO within 5 s.")
+        if delay:
+            time.sleep(delay)
+        delay = min(delay * 2 if delay else 5e-5, 2e-3)
+
+    return bytes(target.fpga_read(REG_CT, 16)[::-1])
 
-    return rd(target.fpga_read(REG_CT, 16))
+
+def _read_trace(scope: RigolScope, out: np.ndarray | None = None) -> np.ndarray:
+    """Wait for the pending acquisition to finish and read it back.
+
+    Runs on the reader thread so the VISA transfer overlaps with the CW305
+    ciphertext read-back and loading of the next plaintext. Voltages are
+    written into `out` when given; raw samples are always returned as read.
+    """
+    scope.wait_for_trace()
+    if POST_TRIGGER_DELAY:
+        time.sleep(POST_TRIGGER_DELAY)
+    return scope.read_raw_trace() if STORE_RAW_SAMPLES else scope.read_single_trace(out=out)
+
+def _save_capture(path: str, scratch_path: str | None, n_traces: int, **arrays):
+    """Write the capture archive with the first `n_traces` waves taken from
+    the on-disk scratch array, then delete the scratch file. If the save
+    fails the scratch file is kept, as it is the only copy of the waves."""
+    if scratch_path is None:
+        savez_zst(path, waves=np.empty((0, 0), dtype=np.float32), **arrays)
+        return
+    waves = np.load(scratch_path, mmap_mode="r")
+    savez_zst(path, waves=waves[:n_traces], **arrays)
+    del waves  # unmap before deleting the scratch file
+    os.remove(scratch_path)
 
 # ----------------------------
 # Main capture loop
@@ -389,14 +548,20 @@ def main():
     Steps:
     1. Ensure output directory exists.
     2. Connect to scope and target and configure both.
-    3. For each plaintext: clear+arm the scope, start AES on FPGA, wait and
-       read the trace, store waveform and metadata.
-    4. Save to a compressed .npz file.
+    3. For each plaintext: clear+arm the scope, start AES on FPGA, read the
+       trace on a reader thread while the ciphertext is fetched and the next
+       plaintext loaded, store waveform and metadata.
+    4. Save to a zstd-compressed .npz file.
     """
     os.makedirs(os.path.dirname(SAVE_PATH), exist_ok=True)
 
     scope = RigolScope(visa_resource=RIGOL_VISA_FORCE)
     cw305 = None
+    # Compression runs on its own thread so the instruments are released
+    # while the archive is being written.
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+    scratch_path = None
     try:
         # Connect and configure devices
         scope.connect()
@@ -405,61 +570,118 @@ def main():
 
         key = bytes.fromhex(FIXED_KEY_HEX)
         pts = make_plaintexts(N_TRACES)
-        traces = []
-        metadata = []
-
-        for i, pt in enumerate(pts):
-            # Clear previous acquisition and arm the scope. The function
-            # will retry internally up to SCOPE_ARM_RETRIES times.
-            armed = scope.clear_and_arm(delay_after_sing=SCOPE_ARM_DELAY)
-            if not armed:
-                print(f"[WARN] Trace {i+1}: scope did not report armed within {SCOPE_ARM_TIMEOUT}s; retrying...")
-                armed = scope.clear_and_arm(delay_after_sing=SCOPE_ARM_DELAY)
-
-            if not armed:
-                msg = f"Scope failed to arm for trace {i+1} after {SCOPE_ARM_RETRIES} attempts."
-                if SKIP_ON_ARM_FAIL:
-                    print("[WARN] " + msg + " Skipping this trace and continuing.")
-                    # Skip this trace but keep loop running
-                    continue
-                else:
-                    raise RuntimeError(msg + " Aborting.")
-
-            # Scope is confirmed armed/waiting for trigger. Start AES on FPGA.
-            ct = run_aes(cw305, pt, key)
-
-            # Wait for scope to complete acquisition and collect waveform
-            scope.wait_for_trace()
-            if POST_TRIGGER_DELAY:
-                time.sleep(POST_TRIGGER_DELAY)
-
+        # Reverse key and all plaintexts into FPGA byte order up front
+        key_rev = key[::-1]
+        pts_rev = _byteswap16_bulk(pts)
+        load_aes_key(cw305, key_rev)
+        # Results are written straight into preallocated arrays; `n_captured`
+        # is the next free row, since skipped traces leave no entry. Waves
+        # go into an on-disk scratch array, sized from the first trace the
+        # scope returns, so RAM use does not grow with N_TRACES.
+        waves = None
+        pts_arr = np.empty((N_TRACES, 16), dtype=np.uint8)
+        cts_arr = np.empty((N_TRACES, 16), dtype=np.uint8)
+        n_captured = 0
+
+        def load_inputs(i):
+            load_aes_inputs(cw305, pts_rev[16*i:16*(i+1)])
+
+        def collect(i, ct, pending_trace, out):
+            nonlocal waves, scratch_path, n_captured
             try:
-                trace = scope.read_single_trace()
+                trace = pending_trace.result()
             except Exception as e:
                 print(f"[ERROR] Failed to read trace {i+1}: {e}")
                 if SKIP_ON_ARM_FAIL:
                     print("[WARN] Skipping this trace due to read error.")
-                    continue
+                    return
                 else:
                     raise
 
-            traces.append(trace)
-            metadata.append(TraceMeta(pt=pt, key=key, ct=ct))
+            if waves is None:
+                scratch_path = SAVE_PATH + ".waves.npy"
+                waves = np.lib.format.open_memmap(
+                    scratch_path, mode="w+", dtype=trace.dtype,
+                    shape=(N_TRACES, len(trace)))
+            if trace is not out:
+                waves[n_captured] = trace
+            pts_arr[n_captured] = pts[i]
+            cts_arr[n_captured] = np.frombuffer(ct, dtype=np.uint8)
+            n_captured += 1
 
             if (i+1) % 100 == 0:
                 print(f"[INFO] Captured {i+1}/{N_TRACES} traces")
 
-        # Convert lists to numpy arrays and save
-        waves = np.asarray(traces, dtype=np.float32)
-        pts_arr = np.array([list(m.pt) for m in metadata], dtype=np.uint8)
-        keys_arr = np.array([list(m.key) for m in metadata], dtype=np.uint8)
-        cts_arr = np.array([list(m.ct) for m in metadata], dtype=np.uint8)
+        # Two-stage pipeline: the reader thread transfers waveform i from the
+        # scope while this thread reads ciphertext i from the CW305 and loads
+        # plaintext i+1. The scope is only re-armed once waveform i is in.
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            pending = None
+            load_inputs(0)
+            for i in range(N_TRACES):
+                if pending is not None:
+                    collect(*pending)
+                    pending = None
+
+                # Clear previous acquisition and arm the scope. The function
+                # will retry internally up to SCOPE_ARM_RETRIES times.
+                armed = scope.clear_and_arm(delay_after_sing=SCOPE_ARM_DELAY)
+                if not armed:
+                    print(f"[WARN] Trace {i+1}: scope did not report armed within {SCOPE_ARM_TIMEOUT}s; retrying...")
+                    armed = scope.clear_and_arm(delay_after_sing=SCOPE_ARM_DELAY)
+
+                if not armed:
+                    msg = f"Scope failed to arm for trace {i+1} after {SCOPE_ARM_RETRIES} attempts."
+                    if SKIP_ON_ARM_FAIL:
+                        print("[WARN] " + msg + " Skipping this trace and continuing.")
+                        # Skip this trace but keep loop running
+                        if i + 1 < N_TRACES:
+                            load_inputs(i + 1)
+                        continue
+                    else:
+                        raise RuntimeError(msg + " Aborting.")
+
+                # Scope is confirmed armed/waiting for trigger. Start AES on FPGA.
+                start_aes(cw305)
+
+                # Collect the waveform in the background, fetch the
+                # ciphertext and prepare the next encryption meanwhile
+                # Once the buffer exists the voltages go straight into the
+                # next free row (rows are only claimed in collect, so a failed
+                # read just leaves it to be overwritten).
+                out = None if waves is None or STORE_RAW_SAMPLES else waves[n_captured]
+                pending_trace = reader.submit(_read_trace, scope, out)
+                ct = read_aes_result(cw305)
+                if i + 1 < N_TRACES:
+                    load_inputs(i + 1)
+                pending = (i, ct, pending_trace, out)
+
+            if pending is not None:
+                collect(*pending)
+
+        # Trim the preallocated arrays to the traces actually captured. The
+        # waves are handed over by path; the saver maps the scratch file
+        # itself and deletes it once the archive is written.
+        if waves is not None:
+            waves.flush()
+        # Drop every view of the memmap (the last `out` row and the trace
+        # held by the last future) so the file can be deleted on Windows
+        waves = out = pending = None
+        pts_arr = pts_arr[:n_captured]
+        cts_arr = cts_arr[:n_captured]
+        # The key is fixed; a broadcast view avoids materialising N copies
+        # before the archive is written
+        keys_arr = np.broadcast_to(np.frombuffer(key, dtype=np.uint8), (n_captured, 16))
 
         rigol_meta = {
             'acq_mode': ACQUISITION_MODE,
             'hardware_averages': HARDWARE_AVERAGES if ACQUISITION_MODE == 'AVERAGE' else 1,
             'bandwidth_limit_mhz': BANDWIDTH_LIMIT_MHZ,
             'points_per_trace': POINTS_PER_TRACE,
+            'raw_samples': STORE_RAW_SAMPLES,
+            'y_inc': scope.y_inc,
+            'y_org': scope.y_org,
+            'y_ref': scope.y_ref,
             'time_per_div_s': TIME_PER_DIV,
             'vertical_scale_v': VERTICAL_SCALE_V,
             'scope_arm_delay_s': SCOPE_ARM_DELAY,
@@ -467,16 +689,19 @@ def main():
             'scope_arm_retries': SCOPE_ARM_RETRIES,
         }
 
-        np.savez_compressed(
+        pending_save = saver.submit(
+            _save_capture,
             SAVE_PATH,
-            waves=waves,
+            scratch_path,
+            n_captured,
             plaintexts=pts_arr,
             keys=keys_arr,
             ciphertexts=cts_arr,
-            rigol_config=rigol_meta,
-            target_config={'bitstream': os.path.basename(BITSTREAM)}
+            # Configs are stored as JSON strings rather than pickled dicts so
+            # the archive can be loaded with allow_pickle=False
+            rigol_config=json.dumps(rigol_meta),
+            target_config=json.dumps({'bitstream': os.path.basename(BITSTREAM)})
         )
-        print(f"[SUCCESS] Saved {waves.shape[0]} traces to {SAVE_PATH}")
 
     finally:
         # Always attempt to cleanly disconnect
@@ -486,6 +711,18 @@ def main():
                 cw305.dis()
             except Exception:
                 pass
+        if pending_save is None and scratch_path is not None:
+            # Aborted before the save was submitted: the partial waves have
+            # no saved metadata, so drop the scratch file. Unmap first.
+            waves = out = pending = None
+            try:
+                os.remove(scratch_path)
+            except OSError as e:
+                print(f"[WARN] Could not remove scratch file {scratch_path}: {e}")
+        saver.shutdown(wait=True)
+
+    pending_save.result()
+    print(f"[SUCCESS] Saved {n_captured} traces to {SAVE_PATH}")
 
 if __name__ == "__main__":
     main()
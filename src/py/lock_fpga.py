@@ -3,15 +3,17 @@ import argparse
 from datetime import datetime, timedelta
 import getpass
 import json
+import tempfile
 
 LOCK_FILE = "/tmp/fpga_lock.json"  # Path to the lock file in JSON format
 
 def read_lock_file():
     """Read and parse the lock file (in JSON format), returning its contents as a dictionary."""
-    if os.path.exists(LOCK_FILE):
+    try:
         with open(LOCK_FILE, 'r') as lock:
             return json.load(lock)  # Parse the JSON data
-    return None
+    except FileNotFoundError:
+        return None
 
 def check_lock():
     """Check the status of the lock file."""
@@ -23,13 +25,52 @@ def check_lock():
     else:
         print("No lock file exists. FPGA is available.")
 
+def publish_lock_file(lock_data, overwrite=False):
+    """Write the lock file so readers only ever see it complete.
+
+    The JSON is written to a temporary file next to LOCK_FILE and then moved into place.
+    Without overwrite this uses os.link, which fails with FileExistsError if a lock already exists.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(LOCK_FILE), prefix=".fpga_lock.")
+    try:
+        with os.fdopen(fd, 'w') as lock:
+            json.dump(lock_data, lock, indent=4)
+        # Set the file permissions to 0666 (read and write for owner, group, and others)
+        os.chmod(tmp_path, 0o666)
+        if overwrite:
+            os.replace(tmp_path, LOCK_FILE)
+        else:
+            os.link(tmp_path, LOCK_FILE)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
 def lock_fpga(hours):
     """Lock the FPGA by creating a lock file in JSON format."""
-    lock_data = read_lock_file()
     current_user = getpass.getuser()
+    creation_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    estimated_end_time = (datetime.now() + timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S")
     
-    if lock_data:
-        existing_user = lock_data.get('User')
+    # Create or overwrite the lock file with all necessary details in JSON format
+    lock_data = {
+        "User": current_user,
+        "Creation Time": creation_time,
+        "Estimated End Time": estimated_end_time
+    }
+    
+    while True:
+        try:
+            publish_lock_file(lock_data)
+            break
+        except FileExistsError:
+            existing_lock = read_lock_file()
+        
+        if existing_lock is None:
+            # Unlocked since the create failed, so try again
+            continue
+        existing_user = existing_lock.get('User')
         
         if existing_user == current_user:
             # Lock exists for the current user, ask if they want to overwrite
@@ -39,27 +80,13 @@ def lock_fpga(hours):
                 return
             else:
                 print("Overwriting the existing lock.")
+                publish_lock_file(lock_data, overwrite=True)
+                break
         else:
             print(f"The FPGA is currently locked by {existing_user}.")
             print(f"Use the unlock command first to unlock the FPGA.")
             return
     
-    creation_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    estimated_end_time = (datetime.now() + timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S")
-    
-    # Create or overwrite the lock file with all necessary details in JSON format
-    lock_data = {
-        "User": current_user,
-        "Creation Time": creation_time,
-        "Estimated End Time": estimated_end_time
-    }
-    
-    with open(LOCK_FILE, 'w') as lock:
-        json.dump(lock_data, lock, indent=4)
-    
-    # Set the file permissions to 0666 (read and write for owner, group, and others)
-    os.chmod(LOCK_FILE, 0o666)
-    
     print(f"FPGA locked by {current_user}.")
     print(f"Lock file created. Estimated end time: {estimated_end_time}")
 
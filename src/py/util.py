@@ -1,3 +1,9 @@
+import io
+import tempfile
+
+import numpy as np
+
+
 def hw_slow(a:int):
     """Hamming weight of binary representation of a assuming the given number of bits (if a<0 assume 2's complement)."""
     cnt = 0
@@ -6,15 +12,55 @@ def hw_slow(a:int):
         a = a >> 1
     return cnt
 
-hamming_dict = {i: hw_slow(i) for i in range(256)}
-
 def hw(a:int):
-    """Hamming weight of binary representation of a assuming the given number of bits (if a<0 assume 2's complement)."""
-    cnt = 0
-    while a:
-        cnt += hamming_dict[a%256]
-        a = a >> 8
-    return cnt
+    """Hamming weight of binary representation of a (a>=0); int.bit_count is a single popcount instead of a per-byte loop."""
+    if a < 0:
+        raise ValueError(f"hw expects a non-negative integer, got {a}")
+    return a.bit_count()
 
 def hd(a:int, b:int):
-    return hw(a ^ b)
\ No newline at end of file
+    return hw(a ^ b)
+
+# Byte -> Hamming weight lookup table for the vectorised helpers
+_hw_lut = np.array([hw_slow(i) for i in range(256)], dtype=np.uint8)
+
+def hw_array(a:np.ndarray):
+    """Element-wise Hamming weight of an integer array (signed values count their 2's complement bits at the dtype's width)."""
+    a = np.asarray(a)
+    if not np.issubdtype(a.dtype, np.integer):
+        raise TypeError(f"hw_array expects an integer array, got {a.dtype}")
+    # Byte view needs a contiguous array of at least one dimension; the result is reshaped back to a.shape
+    per_byte = _hw_lut[np.ascontiguousarray(a).view(np.uint8)]
+    if a.itemsize == 1:
+        return per_byte.reshape(a.shape)
+    return per_byte.reshape(*a.shape, a.itemsize).sum(axis=-1, dtype=np.uint8)
+
+def hd_array(a:np.ndarray, b:np.ndarray):
+    """Element-wise Hamming distance of two integer arrays (broadcast against each other)."""
+    return hw_array(np.bitwise_xor(a, b))
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def savez_zst(path:str, level:int=3, **arrays):
+    """Save arrays as an uncompressed .npz archive wrapped in a multi-threaded zstd frame.
+
+    The archive is staged in a temporary file rather than in memory, so memmapped
+    arrays are paged in while writing instead of being copied into RAM in full."""
+    import zstandard as zstd  # only needed for the archives, not for hw/hd
+    with tempfile.TemporaryFile() as buf:
+        np.savez(buf, **arrays)
+        buf.seek(0)
+        with open(path, "wb") as f:
+            zstd.ZstdCompressor(level=level, threads=-1).copy_stream(buf, f)
+
+def load_npz_zst(path:str, **kwargs):
+    """Load an archive written by savez_zst, or a plain .npz/.npy file; kwargs are passed on to np.load."""
+    with open(path, "rb") as f:
+        if f.read(4) != _ZSTD_MAGIC:
+            return np.load(path, **kwargs)
+        f.seek(0)
+        import zstandard as zstd
+        buf = io.BytesIO()
+        zstd.ZstdDecompressor().copy_stream(f, buf)
+    buf.seek(0)
+    return np.load(buf, **kwargs)